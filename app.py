@@ -1,381 +1,866 @@
 from flask import Flask, request, jsonify
+from flask.json.provider import DefaultJSONProvider
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
-import json
+import sys
+import logging
+import logging.handlers
+import atexit
 import time
+import random
+import queue
+import re
 import threading
-from datetime import datetime, timezone
+import hashlib
+from functools import lru_cache
+from itertools import takewhile
+from concurrent.futures import ThreadPoolExecutor
+from cachetools import TTLCache
 from dotenv import load_dotenv
 
 load_dotenv()
 
-app = Flask(__name__)
+# 日志写到 stdout；start_background_threads 启动 QueueListener 后改为先进队列，
+# 日志收集端阻塞时不拖慢请求线程。未启动监听线程的进程（脚本、gunicorn 主进程）直接输出
+log_queue = queue.SimpleQueue()
+log_stream_handler = logging.StreamHandler(sys.stdout)
+log_stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+logging.basicConfig(
+    level=os.getenv("LOG_LEVEL", "INFO"),
+    handlers=[log_stream_handler],
+)
+log = logging.getLogger("clickup")
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON 序列化/解析改用 orjson（C 扩展，比标准库快数倍）"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 
 CLICKUP_TOKEN = os.getenv("CLICKUP_TOKEN")
+if not CLICKUP_TOKEN:
+    # 没有 token 时所有请求都会 401，启动时直接报错
+    raise RuntimeError("CLICKUP_TOKEN is not set")
 HEADERS = {"Authorization": CLICKUP_TOKEN}
+# POST 请求体由 orjson 序列化，需自行声明 Content-Type
+JSON_HEADERS = {"Content-Type": "application/json"}
 
-# API 调用跟踪
-api_call_timestamps = []
-api_lock = threading.Lock()
+# API 重试参数 - Full-jitter 指数退避：在 [0, min(MAX_DELAY, BASE_DELAY * 2^n)] 内随机等待，
+# 避免多个 worker 的重试在同一时刻发出
+MAX_RETRIES = 5
+BASE_DELAY = 0.5
+MAX_DELAY = 30.0
 
-# Webhook 去重
-webhook_timestamps = {}
-webhook_lock = threading.Lock()
+# (连接超时, 读取超时) - 连接阶段失败要快，读取给 ClickUp 留足时间
+API_TIMEOUT = (3.05, 10)
 
-def safe_api_call(url, method='GET', json_data=None, params=None, max_retries=2):
-    """安全的 API 调用，包含速率限制和重试"""
-    global api_call_timestamps
-    
-    # 检查 API 限制
-    current_time = time.time()
-    with api_lock:
-        # 移除1分钟前的记录
-        api_call_timestamps = [ts for ts in api_call_timestamps if current_time - ts < 60]
-        
-        # 如果接近限制，等待
-        if len(api_call_timestamps) >= 90:  # 留10个缓冲
-            oldest_call = min(api_call_timestamps)
-            wait_time = 60 - (current_time - oldest_call)
-            if wait_time > 0:
-                print(f"⏳ 接近API限制，等待 {wait_time:.1f}秒")
-                time.sleep(wait_time + 1)
-                # 重置计数器
-                api_call_timestamps.clear()
-    
-    # 执行请求
-    headers = HEADERS.copy()
-    if method == 'POST':
-        headers["Content-Type"] = "application/json"
-    
-    for attempt in range(max_retries + 1):
+class ClickUpRetry(Retry):
+    """urllib3 Retry - 429 没有 Retry-After 时按 ClickUp 的 X-RateLimit-Reset 等待"""
+
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+        if retry_after is None and response.status == 429:
+            reset_at = response.headers.get("X-RateLimit-Reset")
+            if reset_at:
+                try:
+                    return max(0.0, float(reset_at) - time.time())
+                except ValueError:
+                    pass
+        return retry_after
+
+    def get_backoff_time(self):
+        # 只计算最近一段连续错误（忽略重定向），与 urllib3 默认实现一致
+        consecutive_errors = len(list(
+            takewhile(lambda x: x.redirect_location is None, reversed(self.history))
+        ))
+        if consecutive_errors == 0:
+            return 0
+        return random.uniform(0, min(MAX_DELAY, BASE_DELAY * 2 ** (consecutive_errors - 1)))
+
+    def sleep(self, response=None):
+        # 重试只会发生在 safe_api_call 持有的并发名额内；退避和等待令牌期间先让出名额
+        clickup_semaphore.release()
         try:
+            super().sleep(response)
+            # 适配器层的重试同样计入客户端限流
+            clickup_rate_limiter.acquire()
+        finally:
+            clickup_semaphore.acquire()
+
+# 客户端限流 - ClickUp 每个 token 限 100 次/分钟，速率和突发量都由所有 gunicorn worker 平分
+# WEB_CONCURRENCY 即 worker 数，由 gunicorn_conf.py 设置；本地 app.run 时为 1
+CLICKUP_RATE_PER_MIN = int(os.getenv("CLICKUP_RATE_PER_MIN", 100))
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", 1))
+CLICKUP_BURST = 20
+CLICKUP_RATE_MAX_WAIT = 5.0
+
+class ClickUpRateLimited(requests.exceptions.RequestException):
+    """本地令牌桶需要等待超过 CLICKUP_RATE_MAX_WAIT 秒，放弃本次调用"""
+
+class TokenBucket:
+    """令牌桶 - 每秒补充 rate 个令牌，最多积累 capacity 个；令牌不足时调用方按排队顺序等待，
+    需要等待超过 max_wait 秒时不取令牌，直接抛出 ClickUpRateLimited"""
+
+    def __init__(self, rate, capacity, max_wait):
+        self.rate = rate
+        self.capacity = capacity
+        self.max_wait = max_wait
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # 允许透支，透支的部分就是需要等待的时间；排在前面的调用方已预定了之前的令牌
+            wait = (1 - self.tokens) / self.rate if self.tokens < 1 else 0
+            if wait > self.max_wait:
+                raise ClickUpRateLimited(f"ClickUp 限流：需等待 {wait:.1f}s，超过 {self.max_wait}s")
+            self.tokens -= 1
+        if wait:
+            time.sleep(wait)
+
+clickup_rate_limiter = TokenBucket(
+    CLICKUP_RATE_PER_MIN / WEB_CONCURRENCY / 60,
+    max(1, CLICKUP_BURST / WEB_CONCURRENCY),
+    CLICKUP_RATE_MAX_WAIT,
+)
+
+# 每个进程同时发往 ClickUp 的请求数上限，避免并发更新触发 429
+CLICKUP_CONCURRENCY = 5
+clickup_semaphore = threading.BoundedSemaphore(CLICKUP_CONCURRENCY)
+
+# 共享连接池，复用到 api.clickup.com 的 keep-alive 连接；429/5xx 重试在适配器层完成
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=50,
+    max_retries=ClickUpRetry(
+        total=MAX_RETRIES,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["GET", "POST"],
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    ),
+))
+
+# 处理的 ClickUp 列表
+CUSTOMER_LIST_ID = "901811834458"  # Customer List
+ORDER_LIST_ID = "901812062655"  # Order Record
+
+# 订单记录中的客户字段
+CLIENT_NAME_FIELD = "👤 Client Name"
+CLIENT_FIELD = "👤 Client"
+
+# 字段名规范化：去掉开头的 emoji/符号和首尾空白并转小写，"📅 T1 Date " -> "t1 date"
+FIELD_NAME_PREFIX_RE = re.compile(r"^[^\w]+")
+
+# 客户列表任务中需要读取的日期字段（规范化名称 -> 日期槽位）
+DATE_FIELD_SLOTS = {
+    "t1 date": "t1",
+    "t2 date": "t2",
+    "t3 date": "t3",
+    "t4 date": "t4",
+}
+
+# 每个 Interval 字段由哪两个日期计算
+INTERVAL_FIELDS = (
+    ("Interval 1-2", "t1", "t2"),
+    ("Interval 2-3", "t2", "t3"),
+    ("Interval 3-4", "t3", "t4"),
+)
+INTERVAL_FIELD_NAMES = frozenset(name for name, _, _ in INTERVAL_FIELDS)
+
+# 字段名 -> 字段ID 缓存，按列表ID区分
+FIELD_ID_CACHE = TTLCache(maxsize=256, ttl=3600)
+field_id_lock = threading.Lock()
+
+# Webhook 合并窗口 - 同一任务在窗口内连续触发的事件合并为一次处理，使用最后一次的数据
+DEBOUNCE_WINDOW = 1.0
+pending_webhooks = {}  # task_id -> (计时器, [payload, ...])
+webhook_lock = threading.Lock()
+
+# 重复投递去重 - ClickUp 重试会发送完全相同的请求体，SEEN_BODY_TTL 秒内只处理一次
+# 配置 REDIS_URL 时多个 worker 共享，否则使用进程内 TTL 缓存
+SEEN_BODY_TTL = 300
+seen_bodies = TTLCache(maxsize=4096, ttl=SEEN_BODY_TTL)
+
+REDIS_URL = os.getenv("REDIS_URL")
+redis_client = None
+if REDIS_URL:
+    import redis
+    redis_client = redis.from_url(REDIS_URL)
+
+# 客户列表 名称 -> 任务ID 索引缓存
+CUSTOMER_INDEX_TTL = 300
+CUSTOMER_INDEX_MIN_REFRESH = 30
+customer_index_cache = {"index": {}, "ts": 0.0, "refresh": None}  # refresh: 进行中刷新的完成事件
+customer_index_lock = threading.Lock()
+
+# 后台处理队列 - 有界，积压过多时丢弃新的 webhook
+WEBHOOK_WORKERS = 4
+webhook_queue = queue.Queue(maxsize=1000)
+
+# Interval 字段并发更新 - 每个后台线程最多同时发出 len(INTERVAL_FIELDS) 个 POST
+field_update_executor = ThreadPoolExecutor(
+    max_workers=WEBHOOK_WORKERS * len(INTERVAL_FIELDS),
+    thread_name_prefix="field-update",
+)
+
+# 任务 ETag 缓存 - task_id -> (ETag, 任务数据)
+task_etag_cache = TTLCache(maxsize=1024, ttl=60)
+task_etag_lock = threading.Lock()
+
+# 同一任务的处理串行化，避免重叠的 webhook 同时调用 API
+# task_id -> [锁, 引用数]；入队时加引用、处理结束后减引用，引用归零才删除，持有中的锁不会被回收
+task_locks = {}
+
+def safe_api_call(url, method='GET', json_data=None, params=None, headers=None):
+    """ClickUp API 调用 - 负责限流、超时和并发上限，429/5xx 和连接错误的重试由 SESSION 的 ClickUpRetry 处理"""
+    try:
+        # 先取令牌再占并发名额，等待令牌时不占用名额
+        clickup_rate_limiter.acquire()
+        with clickup_semaphore:
             if method == 'POST':
-                response = requests.post(url, headers=headers, json=json_data, timeout=10)
-            else:
-                # 修复：正确处理 GET 请求的 params 参数
-                response = requests.get(url, headers=headers, params=params, timeout=10)
-            
-            # 记录成功的 API 调用
-            with api_lock:
-                api_call_timestamps.append(time.time())
-            
-            if response.status_code == 429:
-                print(f"⚠️ API 限制触发，等待重试...")
-                time.sleep(5)
-                continue
-                
-            return response
-            
-        except requests.exceptions.Timeout:
-            print(f"⏰ 请求超时，重试 {attempt + 1}/{max_retries + 1}")
-            if attempt < max_retries:
-                time.sleep(2)
-                continue
-            else:
-                raise
-        except Exception as e:
-            print(f"❌ 请求异常: {str(e)}")
-            if attempt < max_retries:
-                time.sleep(2)
-                continue
-            else:
-                raise
-    
-    return None
+                return SESSION.post(url, data=orjson.dumps(json_data), headers=JSON_HEADERS, timeout=API_TIMEOUT)
+            return SESSION.get(url, params=params, headers=headers, timeout=API_TIMEOUT)
+    except requests.exceptions.RequestException as e:
+        log.error("❌ 请求异常: %s", e)
+        raise
 
+@lru_cache(maxsize=1024)
+def normalize_field_name(name):
+    return FIELD_NAME_PREFIX_RE.sub("", name).strip().lower()
 
-def parse_date(timestamp):
+@lru_cache(maxsize=1024)
+def parse_ms(timestamp):
+    """ClickUp 日期字段是毫秒时间戳，直接转为整数，无需构造 datetime"""
     try:
-        return datetime.fromtimestamp(int(timestamp) / 1000, tz=timezone.utc)
+        return int(timestamp)
     except (ValueError, TypeError):
         return None
 
+@lru_cache(maxsize=1024)
 def format_diff(diff_seconds):
     if diff_seconds < 0:
         return ""
-    days = int(diff_seconds // 86400)
-    hours = int((diff_seconds % 86400) // 3600)
-    minutes = int((diff_seconds % 3600) // 60)
-    return f"{days}d {hours}h {minutes}m"
+    days, rem = divmod(int(diff_seconds), 86400)
+    hours, rem = divmod(rem, 3600)
+    return f"{days}d {hours}h {rem // 60}m"
 
-def update_interval_field(task_id, field_name, interval_text):
-    """更新Interval字段 - 安全版本"""
+def fetch_task(task_id):
+    """获取任务详情，失败时返回 None；缓存过 ETag 时发送条件请求，304 直接复用上次的数据"""
+    with task_etag_lock:
+        cached = task_etag_cache.get(task_id)
+    headers = {"If-None-Match": cached[0]} if cached else None
+    
+    res = safe_api_call(f"https://api.clickup.com/api/v2/task/{task_id}", headers=headers)
+    if res.status_code == 304 and cached:
+        return cached[1]
+    if res.status_code != 200:
+        log.error("❌ 获取任务失败 %s: %s", task_id, res.status_code)
+        return None
+    
+    task = orjson.loads(res.content)
+    etag = res.headers.get("ETag")
+    if etag:
+        with task_etag_lock:
+            task_etag_cache[task_id] = (etag, task)
+    return task
+
+def get_field_ids(list_id, fields):
+    """字段名 -> 字段ID 映射 - 按列表缓存，字段ID在同一列表内是稳定的"""
+    with field_id_lock:
+        field_ids = FIELD_ID_CACHE.get(list_id)
+        if field_ids is None:
+            field_ids = {f.get("name"): f.get("id") for f in fields}
+            if list_id:
+                FIELD_ID_CACHE[list_id] = field_ids
+    return field_ids
+
+def invalidate_field_ids(list_id):
+    """字段被删除或重命名时清除该列表的字段ID缓存"""
+    with field_id_lock:
+        FIELD_ID_CACHE.pop(list_id, None)
+
+def update_interval_field(task_id, field_name, interval_text, field_ids, list_id=None):
+    """更新Interval字段 - 使用预先构建的字段ID映射，无需重新获取任务"""
     try:
-        res = safe_api_call(f"https://api.clickup.com/api/v2/task/{task_id}")
-        if res.status_code != 200:
-            print(f"❌ 获取任务失败: {res.status_code}")
+        field_id = field_ids.get(field_name)
+        if not field_id:
+            log.error("❌ 未找到字段: %s", field_name)
+            invalidate_field_ids(list_id)
             return False
-            
-        fields = res.json().get("custom_fields", [])
         
-        for field in fields:
-            if field.get("name") == field_name:
-                field_id = field["id"]
-                url = f"https://api.clickup.com/api/v2/task/{task_id}/field/{field_id}"
-                data = {"value": interval_text}
-                
-                r = safe_api_call(url, method='POST', json_data=data)
-                success = r.status_code in (200, 201)
-                if success:
-                    print(f"✅ 更新 {field_name}: {interval_text}")
-                else:
-                    print(f"❌ 更新失败 {field_name}: {r.status_code}")
-                return success
-                
-        print(f"❌ 未找到字段: {field_name}")
-        return False
+        url = f"https://api.clickup.com/api/v2/task/{task_id}/field/{field_id}"
+        data = {"value": interval_text}
+        
+        r = safe_api_call(url, method='POST', json_data=data)
+        success = r.status_code in (200, 201)
+        if success:
+            log.info("✅ 更新 %s: %s", field_name, interval_text)
+        else:
+            log.error("❌ 更新失败 %s: %s", field_name, r.status_code)
+            if r.status_code == 404:
+                invalidate_field_ids(list_id)
+        return success
         
     except Exception as e:
-        print(f"❌ 更新字段异常: {str(e)}")
+        log.error("❌ 更新字段异常: %s", e)
         return False
 
-def calculate_all_intervals(task_id):
-    """计算所有日期间隔 - 安全版本"""
+def update_interval_fields(task_id, updates, field_ids, list_id=None):
+    """并发更新多个Interval字段 - ClickUp 没有批量字段接口，三次 POST 并行发出"""
+    futures = [
+        field_update_executor.submit(update_interval_field, task_id, field_name, interval_text, field_ids, list_id)
+        for field_name, interval_text in updates
+    ]
+    return [f.result() for f in futures]
+
+def changed_date_slots(data):
+    """从 webhook 的 history_items 中找出被修改的日期字段
+    
+    无法判断时返回 None（全部重新计算），包括新建任务、移动列表、状态变化等非自定义字段的变更；
+    只改了其他自定义字段（例如本服务写入的 Interval）时返回空集合。
+    """
+    history_items = data.get("history_items")
+    if not history_items:
+        return None
+    
+    slots = set()
+    for item in history_items:
+        if item.get("field") != "custom_field":
+            return None
+        name = (item.get("custom_field") or {}).get("name")
+        if name is None:
+            return None
+        slot = DATE_FIELD_SLOTS.get(normalize_field_name(name))
+        if slot:
+            slots.add(slot)
+    return slots
+
+def calculate_all_intervals(task_id, task=None, changed_slots=None):
+    """计算日期间隔 - 已有任务数据时不再重复获取，changed_slots 为 None 时全部重新计算"""
     try:
-        res = safe_api_call(f"https://api.clickup.com/api/v2/task/{task_id}")
-        if res.status_code != 200:
-            print(f"❌ 获取任务失败: {res.status_code}")
-            return
+        if task is None:
+            task = fetch_task(task_id)
+            if task is None:
+                return
         
-        task = res.json()
         fields = task.get("custom_fields", [])
         
-        # 提取日期字段值
+        # 字段名 -> 字段ID，供三个 Interval 更新复用
+        list_id = task.get("list", {}).get("id")
+        field_ids = get_field_ids(list_id, fields)
+        
+        # 提取日期字段值和 Interval 当前值 - 找齐所需字段后提前结束扫描
         dates = {}
+        current_values = {}
+        wanted = len(DATE_FIELD_SLOTS) + len(INTERVAL_FIELD_NAMES)
         for field in fields:
             name = field.get("name", "")
-            value = field.get("value")
-            
-            if "📅 T1 Date" in name: dates['t1'] = value
-            elif "📅 T2 Date" in name: dates['t2'] = value
-            elif "📅 T3 Date" in name: dates['t3'] = value
-            elif "📅 T4 Date" in name: dates['t4'] = value
-        
-        print(f"📅 日期状态: T1={dates.get('t1')}, T2={dates.get('t2')}, T3={dates.get('t3')}, T4={dates.get('t4')}")
+            slot = DATE_FIELD_SLOTS.get(normalize_field_name(name))
+            if slot:
+                dates[slot] = field.get("value")
+            elif (name := name.strip()) in INTERVAL_FIELD_NAMES:
+                current_values[name] = field.get("value") or ""
+            else:
+                continue
+            if len(dates) + len(current_values) == wanted:
+                break
         
-        # 计算间隔
-        if dates.get('t1') and dates.get('t2'):
-            d1 = parse_date(dates['t1'])
-            d2 = parse_date(dates['t2'])
-            if d1 and d2:
-                diff_seconds = (d2 - d1).total_seconds()
-                interval_12 = format_diff(diff_seconds)
-                update_interval_field(task_id, "Interval 1-2", interval_12)
-        else:
-            update_interval_field(task_id, "Interval 1-2", "")
+        log.info("📅 日期状态: T1=%s, T2=%s, T3=%s, T4=%s", dates.get('t1'), dates.get('t2'), dates.get('t3'), dates.get('t4'))
         
-        if dates.get('t2') and dates.get('t3'):
-            d2 = parse_date(dates['t2'])
-            d3 = parse_date(dates['t3'])
-            if d2 and d3:
-                diff_seconds = (d3 - d2).total_seconds()
-                interval_23 = format_diff(diff_seconds)
-                update_interval_field(task_id, "Interval 2-3", interval_23)
-        else:
-            update_interval_field(task_id, "Interval 2-3", "")
+        # 计算间隔，收集待更新的 (字段名, 值)；只处理输入日期有变化的间隔
+        timestamps = {slot: parse_ms(value) for slot, value in dates.items() if value}
+        updates = []
+        for field_name, start, end in INTERVAL_FIELDS:
+            if changed_slots is not None and not changed_slots & {start, end}:
+                continue
+            if dates.get(start) and dates.get(end):
+                start_ms = timestamps[start]
+                end_ms = timestamps[end]
+                if start_ms is not None and end_ms is not None:
+                    diff_seconds = (end_ms - start_ms) // 1000
+                    updates.append((field_name, format_diff(diff_seconds)))
+            else:
+                updates.append((field_name, ""))
         
-        if dates.get('t3') and dates.get('t4'):
-            d3 = parse_date(dates['t3'])
-            d4 = parse_date(dates['t4'])
-            if d3 and d4:
-                diff_seconds = (d4 - d3).total_seconds()
-                interval_34 = format_diff(diff_seconds)
-                update_interval_field(task_id, "Interval 3-4", interval_34)
+        # 跳过与当前值相同的更新
+        updates = [(name, text) for name, text in updates if current_values.get(name, "") != text]
+        if updates:
+            update_interval_fields(task_id, updates, field_ids, list_id)
         else:
-            update_interval_field(task_id, "Interval 3-4", "")
+            log.info("⏭️ Interval 字段无变化，跳过更新")
             
     except Exception as e:
-        print(f"❌ 计算间隔异常: {str(e)}")
+        log.error("❌ 计算间隔异常: %s", e)
+
+# 关系字段验证轮询间隔（秒）
+VERIFY_DELAYS = (0, 0.25, 0.5, 1.0)
 
 def verify_relationship_update(task_id, client_field_id, expected_client_id):
     """验证关系字段更新是否成功"""
-    print(f"🔍 Verifying relationship field update...")
-    time.sleep(2)
+    log.info("🔍 Verifying relationship field update...")
     
-    verify_res = safe_api_call(f"https://api.clickup.com/api/v2/task/{task_id}")
-    if verify_res.status_code == 200:
-        verify_task = verify_res.json()
-        verify_fields = verify_task.get("custom_fields", [])
+    # 首次立即检查，字段仍为空时按 VERIFY_DELAYS 退避重试
+    for delay in VERIFY_DELAYS:
+        time.sleep(delay)
+        verify_task = fetch_task(task_id)
+        if verify_task is None:
+            log.error("   ❌ Verification request failed")
+            return False
         
-        for field in verify_fields:
-            if field.get("id") == client_field_id:
-                linked_value = field.get("value")
-                print(f"   🔍 Client field current value: {linked_value}")
-                
-                if linked_value and len(linked_value) > 0:
-                    if isinstance(linked_value[0], dict):
-                        actual_id = linked_value[0].get('id')
-                    else:
-                        actual_id = linked_value[0]
-                    
-                    if actual_id == expected_client_id:
-                        print(f"   🎉 SUCCESS! Client relationship established: {actual_id}")
-                        return True
-                    else:
-                        print(f"   ⚠️ Client linked but with different ID: {actual_id} vs {expected_client_id}")
-                        return True
-                else:
-                    print(f"   ❌ Client field is still empty!")
-                    return False
-        print(f"   ❌ Could not find Client field for verification")
-        return False
+        # 字段ID -> 字段，直接按ID取值
+        by_id = {f.get("id"): f for f in verify_task.get("custom_fields", [])}
+        field = by_id.get(client_field_id)
+        if field is None:
+            log.error("   ❌ Could not find Client field for verification")
+            return False
+        
+        linked_value = field.get("value")
+        log.debug("   🔍 Client field current value: %s", linked_value)
+        if linked_value:
+            break
     else:
-        print(f"   ❌ Verification request failed: {verify_res.status_code}")
+        log.error("   ❌ Client field is still empty!")
         return False
+    
+    if isinstance(linked_value[0], dict):
+        actual_id = linked_value[0].get('id')
+    else:
+        actual_id = linked_value[0]
+    
+    if actual_id == expected_client_id:
+        log.info("   🎉 SUCCESS! Client relationship established: %s", actual_id)
+    else:
+        log.warning("   ⚠️ Client linked but with different ID: %s vs %s", actual_id, expected_client_id)
+    return True
 
-def handle_order_client_linking(task_id):
-    """处理Order Record的客户链接 - 完整版本"""
-    print(f"🔗 Processing client linking for Order Record: {task_id}")
+def build_customer_index(stop_at=None):
+    """分页获取客户列表，构建 {casefold 后的客户名: 任务ID}
     
-    res = safe_api_call(f"https://api.clickup.com/api/v2/task/{task_id}")
-    if res.status_code != 200:
-        print(f"❌ Failed to fetch order task: {res.status_code}")
-        return
+    找到 stop_at 后提前结束。返回 (index, complete)，请求失败时返回 (None, False)。
+    """
+    search_url = f"https://api.clickup.com/api/v2/list/{CUSTOMER_LIST_ID}/task"
+    index = {}
+    page = 0
+    while True:
+        search_res = safe_api_call(search_url, params={"archived": "false", "page": page})
+        if search_res.status_code != 200:
+            log.error("❌ Failed to search Customer List: %s", search_res.status_code)
+            return None, False
         
-    task = res.json()
-    fields = task.get("custom_fields", [])
+        body = orjson.loads(search_res.content)
+        customer_tasks = body.get("tasks", [])
+        for customer_task in customer_tasks:
+            # 同名客户保留第一个，与原先的线性查找一致
+            index.setdefault(customer_task.get("name", "").strip().casefold(), customer_task.get("id"))
+        
+        if stop_at is not None and stop_at in index:
+            log.debug("🔍 Found '%s' on Customer List page %d", stop_at, page)
+            return index, False
+        if not customer_tasks or body.get("last_page", len(customer_tasks) < 100):
+            break
+        page += 1
+    
+    log.debug("🔍 Found %d tasks in Customer List", len(index))
+    return index, True
+
+def begin_customer_index_refresh():
+    """登记一次索引刷新，同一时间只有一个；返回 (完成事件, 是否由调用方执行)。调用方需持有 customer_index_lock"""
+    done = customer_index_cache["refresh"]
+    if done is not None:
+        return done, False
+    done = customer_index_cache["refresh"] = threading.Event()
+    return done, True
+
+def run_customer_index_refresh(done, stop_at=None):
+    """在锁外分页获取客户列表，结果写回缓存后通知等待者；失败时保留旧数据"""
+    index, complete = None, False
+    try:
+        index, complete = build_customer_index(stop_at=stop_at)
+    except Exception as e:
+        log.warning("⚠️ 客户索引刷新异常: %s", e)
+    finally:
+        with customer_index_lock:
+            customer_index_cache["refresh"] = None
+            if index is not None:
+                if complete:
+                    customer_index_cache["index"] = index
+                    customer_index_cache["ts"] = time.time()
+                else:
+                    customer_index_cache["index"] = {**customer_index_cache["index"], **index}
+        done.set()
+
+def get_customer_index():
+    """获取客户名称索引 - 过期后先返回旧数据并在后台刷新（stale-while-revalidate），首次加载时等待刷新完成"""
+    with customer_index_lock:
+        index = customer_index_cache["index"]
+        if time.time() - customer_index_cache["ts"] < CUSTOMER_INDEX_TTL:
+            return index
+        done, owner = begin_customer_index_refresh()
     
-    # 获取👤 Client Name字段值和👤 Client字段ID
-    client_name = None
-    client_field_id = None
+    if index:
+        if owner:
+            threading.Thread(target=run_customer_index_refresh, args=(done,), daemon=True).start()
+        return index
     
-    print("🔍 Searching for fields in Order Record:")
-    for field in fields:
-        field_name = field.get("name", "")
-        field_value = field.get("value")
-        field_id = field.get("id")
-        
-        if "👤 Client Name" == field_name:
-            client_name = field_value
-            print(f"📝 Found Client Name: {client_name}")
-            
-        elif "👤 Client" == field_name:
-            client_field_id = field_id
-            print(f"🆔 Found Client relationship field ID: {client_field_id}")
+    if owner:
+        run_customer_index_refresh(done)
+    else:
+        done.wait()
+    with customer_index_lock:
+        return customer_index_cache["index"]
+
+def refresh_customer_index(needle):
+    """缓存未命中时重新分页查找，找到 needle 即停止，已获取的页合并进缓存
+    
+    已有刷新在进行时等待它完成并复用结果，不再重复拉取。
+    """
+    with customer_index_lock:
+        if needle in customer_index_cache["index"]:
+            return customer_index_cache["index"]
+        done, owner = customer_index_cache["refresh"], False
+        if done is None:
+            # 最小刷新间隔，避免未知客户名反复触发整表拉取
+            if time.time() - customer_index_cache["ts"] < CUSTOMER_INDEX_MIN_REFRESH:
+                return customer_index_cache["index"]
+            done, owner = begin_customer_index_refresh()
+    
+    if owner:
+        run_customer_index_refresh(done, stop_at=needle)
+    else:
+        done.wait()
+    with customer_index_lock:
+        return customer_index_cache["index"]
+
+def invalidate_customer_index():
+    """客户新建或改名后让名称索引在下次查找时重建"""
+    with customer_index_lock:
+        customer_index_cache["ts"] = 0.0
+
+def customer_names_changed(data):
+    """webhook 是否可能改变了客户名称"""
+    if data.get("event") == "taskCreated":
+        return True
+    return any(item.get("field") in ("name", "task_creation") for item in data.get("history_items") or ())
+
+def find_customer_task_id(client_name):
+    """按名称查找客户任务ID；缓存未命中时刷新一次索引再查"""
+    needle = client_name.strip().casefold()
+    client_task_id = get_customer_index().get(needle)
+    if client_task_id is None:
+        client_task_id = refresh_customer_index(needle).get(needle)
+    return client_task_id
+
+def handle_order_client_linking(task_id, task=None):
+    """处理Order Record的客户链接 - 完整版本，已有任务数据时不再重复获取"""
+    log.info("🔗 Processing client linking for Order Record: %s", task_id)
+    
+    if task is None:
+        task = fetch_task(task_id)
+        if task is None:
+            return
+    
+    fields = task.get("custom_fields", [])
+
+    # 字段名 -> 字段，一次构建后直接按名称取值
+    by_name = {f.get("name", ""): f for f in fields}
+    client_name = by_name.get(CLIENT_NAME_FIELD, {}).get("value")
+
+    # 👤 Client字段ID 从按列表缓存的映射中获取
+    list_id = task.get("list", {}).get("id")
+    client_field_id = get_field_ids(list_id, fields).get(CLIENT_FIELD)
+    log.debug("🆔 Client Name: %s, Client relationship field ID: %s", client_name, client_field_id)
     
     if not client_name:
-        print("⏭️ No 👤 Client Name found in Order Record")
+        log.info("⏭️ No 👤 Client Name found in Order Record")
         return
         
     if not client_field_id:
-        print("❌ 👤 Client relationship field not found in Order Record")
+        log.error("❌ 👤 Client relationship field not found in Order Record")
+        invalidate_field_ids(list_id)
         return
     
-    print(f"🎯 Looking for client: '{client_name}' in Customer List")
+    log.info("🎯 Looking for client: '%s' in Customer List", client_name)
     
-    # 在Customer List中查找匹配的客户
-    CUSTOMER_LIST_ID = "901811834458"
+    # 在Customer List中查找匹配的客户 - 使用缓存的名称索引
+    client_task_id = find_customer_task_id(client_name)
+    if not client_task_id:
+        log.error("❌ No matching client found for: '%s'", client_name)
+        return
+    log.info("✅ Exact match found: '%s' -> %s", client_name.strip(), client_task_id)
     
-    search_url = f"https://api.clickup.com/api/v2/list/{CUSTOMER_LIST_ID}/task"
-    params = {"archived": "false"}
-    search_res = safe_api_call(search_url, params=params)
+    # 使用正确的关系字段API格式 - 完整版本
+    log.debug("🔄 Using correct Relationship Field API format")
+    update_url = f"https://api.clickup.com/api/v2/task/{task_id}/field/{client_field_id}"
     
-    if search_res.status_code == 200:
-        customer_tasks = search_res.json().get("tasks", [])
-        print(f"🔍 Found {len(customer_tasks)} tasks in Customer List")
-        
-        # 精确匹配客户名称
-        matched_task = None
-        for customer_task in customer_tasks:
-            customer_name = customer_task.get("name", "").strip()
-            if customer_name.lower() == client_name.strip().lower():
-                matched_task = customer_task
-                print(f"✅ Exact match found: '{customer_name}' -> {customer_task.get('id')}")
-                break
+    payload = {
+        "value": {
+            "add": [client_task_id],
+            "rem": []
+        }
+    }
+    
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("   URL: %s", update_url)
+        log.debug("   Payload: %s", payload)
+    
+    try:
+        update_res = safe_api_call(update_url, method='POST', json_data=payload)
+        log.info("📡 API response status: %s", update_res.status_code)
+        if log.isEnabledFor(logging.DEBUG):
+            # 只记录响应体前 200 字节，仅在 DEBUG 时解码
+            log.debug("📡 API response content: %s", update_res.content[:200].decode(errors="replace"))
         
-        if matched_task:
-            client_task_id = matched_task.get("id")
-            
-            # 使用正确的关系字段API格式 - 完整版本
-            print("🔄 Using correct Relationship Field API format")
-            update_url = f"https://api.clickup.com/api/v2/task/{task_id}/field/{client_field_id}"
-            
-            payload = {
-                "value": {
-                    "add": [client_task_id],
-                    "rem": []
-                }
-            }
-            
-            # 关键：创建包含 Content-Type 的头部
-            headers_with_content = HEADERS.copy()
-            headers_with_content["Content-Type"] = "application/json"
+        if update_res.status_code in (200, 201):
+            log.info("✅ Relationship field updated successfully!")
+            # 验证需要额外一次 GET，只在调试时执行
+            if log.isEnabledFor(logging.DEBUG):
+                verify_relationship_update(task_id, client_field_id, client_task_id)
+        else:
+            log.error("❌ Failed to update relationship field")
+            if update_res.status_code == 404:
+                invalidate_field_ids(list_id)
+    except Exception as e:
+        log.error("❌ Exception during update: %s", e)
+
+def handle_customer_list_task(task_id, task, data):
+    log.info("🔄 处理客户列表任务")
+    if customer_names_changed(data):
+        invalidate_customer_index()
+    
+    # 没有日期字段变化（例如本服务写入 Interval 触发的回声 webhook）时不获取任务
+    changed_slots = changed_date_slots(data)
+    if changed_slots is not None and not changed_slots:
+        log.info("⏭️ 日期字段无变化，跳过: %s", task_id)
+        return
+    calculate_all_intervals(task_id, task, changed_slots)
+
+def handle_order_record_task(task_id, task, data):
+    log.info("🆕 处理订单记录任务")
+    handle_order_client_linking(task_id, task)
+
+# 列表ID -> 处理函数，新增列表只需在此登记
+LIST_HANDLERS = {
+    CUSTOMER_LIST_ID: handle_customer_list_task,
+    ORDER_LIST_ID: handle_order_record_task,
+}
+
+def payload_list_id(data):
+    """从 webhook 数据中读取列表ID，没有时返回 None；任务事件的 history_items 中 parent_id 即列表ID"""
+    task = data.get("task") or {}
+    list_id = (task.get("list") or {}).get("id") or data.get("list_id")
+    if list_id is None and data.get("history_items"):
+        list_id = data["history_items"][0].get("parent_id")
+    return list_id
+
+def acquire_task_lock(task_id):
+    """取得任务锁并增加引用，调用方结束后需调用 release_task_lock"""
+    with webhook_lock:
+        entry = task_locks.setdefault(task_id, [threading.Lock(), 0])
+        entry[1] += 1
+        return entry[0]
+
+def release_task_lock(task_id):
+    """减少任务锁引用，没有任务再使用时删除"""
+    with webhook_lock:
+        entry = task_locks.get(task_id)
+        if entry is not None:
+            entry[1] -= 1
+            if entry[1] <= 0:
+                del task_locks[task_id]
+
+def process_webhook(task_id, data, task_lock):
+    """后台处理 webhook - 按列表分发，payload 没有列表ID时才先获取任务"""
+    log.info("🎯 处理任务: %s", task_id)
+    
+    try:
+        # 读取任务也在锁内，保证后一次处理读到的是前一次写入之后的数据
+        with task_lock:
+            # payload 自带 custom_fields 时直接使用，否则由处理函数按需获取
+            task = data.get("task") or {}
+            if not (task.get("custom_fields") and task.get("list")):
+                task = None
             
-            print(f"   URL: {update_url}")
-            print(f"   Payload: {json.dumps(payload, indent=2)}")
+            list_id = task["list"].get("id") if task else payload_list_id(data)
+            if list_id is None:
+                # payload 中没有列表ID，只能先获取任务
+                task = fetch_task(task_id)
+                if task is None:
+                    return
+                list_id = task.get("list", {}).get("id")
             
-            try:
-                # 使用 requests 直接发送，而不是 safe_api_call，因为我们需要特定的 headers
-                update_res = requests.post(update_url, headers=headers_with_content, json=payload)
-                print(f"📡 API response status: {update_res.status_code}")
-                print(f"📡 API response content: {update_res.text}")
-                
-                # 记录 API 调用
-                with api_lock:
-                    api_call_timestamps.append(time.time())
+            handler = LIST_HANDLERS.get(list_id)
+            if handler:
+                handler(task_id, task, data)
                 
-                if update_res.status_code in (200, 201):
-                    print(f"✅ Relationship field updated successfully!")
-                    verify_relationship_update(task_id, client_field_id, client_task_id)
-                else:
-                    print(f"❌ Failed to update relationship field")
-            except Exception as e:
-                print(f"❌ Exception during update: {str(e)}")
-        else:
-            print(f"❌ No matching client found for: '{client_name}'")
-    else:
-        print(f"❌ Failed to search Customer List: {search_res.status_code}")
+    except Exception as e:
+        log.warning("⚠️ Webhook处理异常: %s", e)
+    finally:
+        release_task_lock(task_id)
+
+def webhook_worker():
+    """后台工作线程 - 从队列中取出 webhook 依次处理"""
+    while True:
+        job = webhook_queue.get()
+        try:
+            process_webhook(*job)
+        finally:
+            webhook_queue.task_done()
+
+# 后台线程按进程启动 - gunicorn --preload 在 fork 前导入模块，父进程的线程不会被 worker 继承
+background_pid = None
+background_lock = threading.Lock()
+
+def start_background_threads():
+    """在当前进程启动日志监听线程和 webhook 工作线程，重复调用无副作用"""
+    global background_pid
+    if background_pid == os.getpid():
+        return
+    with background_lock:
+        if background_pid == os.getpid():
+            return
+        background_pid = os.getpid()
+        
+        # 监听线程启动后再把根 logger 切换到队列，之前的日志直接输出不会滞留在队列中
+        log_listener = logging.handlers.QueueListener(log_queue, log_stream_handler)
+        log_listener.start()
+        atexit.register(log_listener.stop)
+        root_logger = logging.getLogger()
+        root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+        root_logger.removeHandler(log_stream_handler)
+        
+        for _ in range(WEBHOOK_WORKERS):
+            threading.Thread(target=webhook_worker, daemon=True).start()
+
+def merge_webhook_payloads(payloads):
+    """合并窗口内的多个 payload - 以最后一个为准，history_items 取并集；任一缺失时置空以便全部重新计算"""
+    data = dict(payloads[-1])
+    if len(payloads) > 1:
+        history_items = []
+        for payload in payloads:
+            items = payload.get("history_items")
+            if not items:
+                history_items = None
+                break
+            history_items.extend(items)
+        data["history_items"] = history_items
+    return data
+
+def schedule_webhook(task_id, data):
+    """(重新)安排任务在 DEBOUNCE_WINDOW 秒后处理，窗口内的新事件推迟处理并合并；积压过多时返回 False"""
+    with webhook_lock:
+        timer, payloads = pending_webhooks.pop(task_id, (None, []))
+        if timer is None and (len(pending_webhooks) >= webhook_queue.maxsize or webhook_queue.full()):
+            return False
+        if timer is not None:
+            timer.cancel()
+        payloads.append(data)
+        timer = threading.Timer(DEBOUNCE_WINDOW, flush_webhook, args=(task_id,))
+        timer.daemon = True
+        pending_webhooks[task_id] = (timer, payloads)
+        timer.start()
+    return True
+
+def flush_webhook(task_id):
+    """合并窗口结束 - 把合并后的 webhook 放入后台处理队列"""
+    with webhook_lock:
+        entry = pending_webhooks.get(task_id)
+        # 窗口内又来了新事件时计时器已被替换，由新的计时器负责
+        if entry is None or entry[0] is not threading.current_thread():
+            return
+        del pending_webhooks[task_id]
+    
+    task_lock = acquire_task_lock(task_id)
+    try:
+        webhook_queue.put_nowait((task_id, merge_webhook_payloads(entry[1]), task_lock))
+    except queue.Full:
+        release_task_lock(task_id)
+        log.error("❌ 处理队列已满，丢弃webhook: %s", task_id)
+
+def claim_webhook(body_hash):
+    """登记请求体哈希；SEEN_BODY_TTL 秒内已登记过相同请求体则返回 False"""
+    if redis_client is not None:
+        try:
+            return bool(redis_client.set(f"cu:seen:{body_hash.hex()}", "1", nx=True, ex=SEEN_BODY_TTL))
+        except redis.RedisError as e:
+            log.warning("⚠️ Redis 去重失败，改用本地缓存: %s", e)
+    
+    with webhook_lock:
+        if body_hash in seen_bodies:
+            return False
+        seen_bodies[body_hash] = True
+        return True
+
+def release_webhook(body_hash):
+    """撤销去重登记，之后相同的请求体可以再次被处理"""
+    if redis_client is not None:
+        try:
+            redis_client.delete(f"cu:seen:{body_hash.hex()}")
+        except redis.RedisError as e:
+            log.warning("⚠️ Redis 撤销去重失败: %s", e)
+    
+    with webhook_lock:
+        seen_bodies.pop(body_hash, None)
 
-@app.route("/clickup-webhook", methods=["POST"])
 def clickup_webhook():
-    """Webhook 处理 - 终极安全版本"""
+    """Webhook 处理 - 立即确认，合并窗口结束后由后台线程调用 ClickUp API"""
+    # 正常由 gunicorn 的 post_worker_init 启动，这里兜底（未使用 gunicorn_conf.py 时）
+    start_background_threads()
     data = request.json
     
     task_id = data.get("task_id") or (data.get("task") and data.get("task").get("id"))
     if not task_id:
         return jsonify({"error": "no_task_id"}), 400
-
-    # Webhook 去重 - 5秒内同一个任务只处理一次
-    current_time = time.time()
-    with webhook_lock:
-        if task_id in webhook_timestamps:
-            last_time = webhook_timestamps[task_id]
-            if current_time - last_time < 5:
-                print(f"⏭️ 跳过重复webhook: {task_id}")
-                return jsonify({"status": "skipped_duplicate"}), 200
-        webhook_timestamps[task_id] = current_time
     
-    print(f"🎯 处理任务: {task_id}")
+    # payload 带有列表ID且不是要处理的列表时直接确认，不进入队列也不请求 ClickUp
+    list_id = payload_list_id(data)
+    if list_id is not None and list_id not in LIST_HANDLERS:
+        log.info("⏭️ 列表 %s 无需处理: %s", list_id, task_id)
+        return jsonify({"status": "ignored"}), 200
     
-    try:
-        # 快速响应，避免超时
-        res = safe_api_call(f"https://api.clickup.com/api/v2/task/{task_id}")
-        if res.status_code == 200:
-            task = res.json()
-            list_id = task.get("list", {}).get("id")
-            event_type = data.get('event', '')
-            
-            if list_id == "901811834458":  # Customer List
-                print("🔄 处理客户列表任务")
-                calculate_all_intervals(task_id)
-            elif list_id == "901812062655":  # Order Record
-                print("🆕 处理订单记录任务")
-                handle_order_client_linking(task_id)
-                
-    except Exception as e:
-        print(f"⚠️ Webhook处理异常: {str(e)}")
-        # 仍然返回200，避免ClickUp认为webhook失败
-        return jsonify({"status": "processed_with_errors"}), 200
+    # 相同请求体是 ClickUp 的重复投递，直接确认
+    body_hash = hashlib.blake2b(request.get_data(cache=True), digest_size=16).digest()
+    if not claim_webhook(body_hash):
+        log.info("⏭️ 跳过重复webhook: %s", task_id)
+        return jsonify({"status": "skipped_duplicate"}), 200
+    
+    if not schedule_webhook(task_id, data):
+        # 积压过多：丢弃并记录，撤销登记以便之后相同的请求仍可处理
+        # 仍然返回200，避免ClickUp认为webhook失败（连续失败会被暂停）
+        release_webhook(body_hash)
+        log.warning("⚠️ 处理队列已满，丢弃webhook: %s", task_id)
+        return jsonify({"status": "dropped"}), 200
     
-    return jsonify({"status": "success"}), 200
+    return jsonify({"status": "queued"}), 202
 
-@app.route("/")
 def home():
     return "ClickUp Webhook Server running", 200
 
+def create_app():
+    """创建 Flask 应用 - 生产环境由 gunicorn 加载 app:app"""
+    flask_app = Flask(__name__)
+    flask_app.json = OrjsonProvider(flask_app)
+    flask_app.add_url_rule("/clickup-webhook", view_func=clickup_webhook, methods=["POST"])
+    flask_app.add_url_rule("/", view_func=home)
+    return flask_app
+
+app = create_app()
+
 if __name__ == "__main__":
-    # 保持完整的启动代码
-    from dotenv import load_dotenv
-    load_dotenv()
+    # 仅用于本地开发；生产环境使用 gunicorn -c gunicorn_conf.py
+    start_background_threads()
     port = int(os.environ.get("PORT", 10000))
     app.run(host="0.0.0.0", port=port)
\ No newline at end of file
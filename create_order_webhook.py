@@ -8,12 +8,14 @@ load_dotenv()
 CLICKUP_TOKEN = os.getenv("CLICKUP_TOKEN")
 TEAM_ID = os.getenv("TEAM_ID")
 
-headers = {"Authorization": CLICKUP_TOKEN, "Content-Type": "application/json"}
+# 复用同一连接完成查询、删除和创建
+session = requests.Session()
+session.headers.update({"Authorization": CLICKUP_TOKEN, "Content-Type": "application/json"})
 
 # 删除可能存在的旧webhook
 print("🔍 Checking for existing webhooks...")
 url = f"https://api.clickup.com/api/v2/team/{TEAM_ID}/webhook"
-response = requests.get(url, headers=headers)
+response = session.get(url)
 
 if response.status_code == 200:
     webhooks = response.json().get("webhooks", [])
@@ -22,7 +24,7 @@ if response.status_code == 200:
             webhook_id = webhook["id"]
             print(f"🗑️ Deleting old Order Record webhook: {webhook_id}")
             delete_url = f"https://api.clickup.com/api/v2/webhook/{webhook_id}"
-            delete_response = requests.delete(delete_url, headers=headers)
+            delete_response = session.delete(delete_url)
             print(f"Delete response: {delete_response.status_code}")
 
 # 创建新的Order Record Webhook，监听创建和更新事件
@@ -33,5 +35,5 @@ order_webhook = {
 }
 
 print("🆕 Creating new Order Record Webhook with taskCreated event...")
-response = requests.post(url, headers=headers, json=order_webhook)
+response = session.post(url, json=order_webhook)
 print(f"Order Webhook: {response.status_code} - {response.text}")
\ No newline at end of file
@@ -0,0 +1,17 @@
+# gunicorn 配置 - gthread worker，--preload 让 SESSION 和各缓存在 fork 前创建一次
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 10000)}"
+worker_class = "gthread"
+# worker 数通过 WEB_CONCURRENCY 传给 app.py，每个 worker 分到 ClickUp 限流额度的 1/workers
+workers = int(os.environ.setdefault("WEB_CONCURRENCY", "2"))
+threads = 8
+keepalive = 30
+timeout = 30
+preload_app = True
+
+
+def post_worker_init(worker):
+    # fork 前启动的线程不会被 worker 继承，每个 worker 自己启动后台线程
+    from app import start_background_threads
+    start_background_threads()